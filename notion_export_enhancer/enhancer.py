@@ -8,6 +8,13 @@ import os
 import time
 import re
 import argparse
+import copy
+import struct
+import hashlib
+import heapq
+import threading
+import queue
+import concurrent.futures
 import zipfile
 import urllib.parse
 from datetime import datetime
@@ -18,6 +25,19 @@ from emoji_extractor.extract import Extractor as EmojiExtractor
 from notion.client import NotionClient
 from notion.block import PageBlock
 
+def _sanitizeTitle(title):
+  """
+  Takes a full page title and makes it usable as a file name, invalids replaced
+  with " ", like the normal export
+  """
+  # TODO: These are just Windows reserved characters
+  # TODO: 200 was just a value to stop Windows from complaining
+  newName = re.sub(r"[\\/?:*\"<>|]", " ", title)
+  if len(newName) > 200:
+    print(f"'{newName}' too long, truncating to 200")
+    newName = newName[0:200]
+  return newName
+
 def noteNameRewrite(nCl, originalNameNoExt):
   """
   Takes original name (with no extension) and renames it using the Notion ID
@@ -69,13 +89,8 @@ def noteNameRewrite(nCl, originalNameNoExt):
   # Check for name truncation
   newName = match[1]
   if len(match[1]) == 50:
-    # Use full name instead, invalids replaced with " ", like the normal export
-    # TODO: These are just Windows reserved characters
-    # TODO: 200 was just a value to stop Windows from complaining
-    newName = re.sub(r"[\\/?:*\"<>|]", " ", pageBlock.title)
-    if len(newName) > 200:
-      print(f"'{newName}' too long, truncating to 200")
-      newName = newName[0:200]
+    # Use full name instead
+    newName = _sanitizeTitle(pageBlock.title)
 
   # Add icon to the front if it's there and usable
   icon = pageBlock.icon
@@ -88,14 +103,113 @@ def noteNameRewrite(nCl, originalNameNoExt):
 
   return (newName, createdTime, lastEditedTime)
 
+# Lowercased property names Notion uses for the created/last edited time columns
+# of a database, which end up as lines under the title of each exported row
+_createdPropertyNames = ["created", "created time", "created at"]
+_lastEditedPropertyNames = ["last edited", "last edited time", "updated", "updated at"]
+
+def _readExportedTitleAndProperties(mdPath):
+  """
+  Reads the H1 title and the property lines under it from a Notion exported md file,
+  without reading the whole file
+  @param {string} mdPath Path to the md file on disk
+  @returns {tuple} 2 tuple of the title (None if there was none) and a dict of
+  lowercased property names to their string values
+  """
+  properties = {}
+  try:
+    with open(mdPath, "r", encoding='utf-8') as f:
+      firstLine = f.readline().rstrip("\n")
+      if not firstLine.startswith("# "):
+        return (None, properties)
+      title = firstLine[2:].strip()
+      # Properties come as a block of "Name: Value" lines after a single empty line
+      if f.readline().strip() != "":
+        return (title, properties)
+      for line in f:
+        match = re.match(r"([^:\n]+): (.*)$", line.rstrip("\n"))
+        if not match:
+          break
+        properties[match[1].strip().lower()] = match[2].strip()
+  except (OSError, UnicodeDecodeError):
+    return (None, properties)
+  return (title, properties)
+
+def _parsePropertyTime(properties, propertyNames):
+  """
+  Parses the first property in propertyNames that holds a time like Notion exports
+  them (e.g. "January 2, 2021 4:05 AM")
+  @returns {datetime} The parsed time or None
+  """
+  for name in propertyNames:
+    if name not in properties:
+      continue
+    for timeFormat in ["%B %d, %Y %I:%M %p", "%B %d, %Y"]:
+      try:
+        return datetime.strptime(properties[name], timeFormat)
+      except ValueError:
+        pass
+  return None
+
+def noteNameRewriteFromExport(rootPath, originalPathNoExt):
+  """
+  Takes original path (with no extension) and renames its basename using only the
+  data in the export itself, without querying Notion
+  * Removes the Notion ID
+  * Uses the H1 title of the .md file at the same path for names Notion truncated
+  * Gets the times from the created/last edited properties of that .md file if
+    they're there, otherwise uses the time of the .md file in the original export
+  Icons aren't part of the export so they are never added
+  @param {string} rootPath The path the export was extracted to
+  @param {string} originalPathNoExt Path rooted at rootPath with no extension
+  @returns {tuple} 3 tuple like noteNameRewrite, (None, None, None) if it couldn't
+  be resolved from the export
+  """
+  match = re.search(r"(.+?) ([0-9a-f]{32})$", os.path.basename(originalPathNoExt))
+  if not match:
+    return (None, None, None)
+
+  # Both an .md file and the folder for its children are named after the .md file
+  mdPath = os.path.join(rootPath, f"{originalPathNoExt}.md")
+  title, properties = _readExportedTitleAndProperties(mdPath)
+
+  # Check for name truncation
+  newName = match[1]
+  if len(match[1]) == 50:
+    if not title:
+      print(f"No title in export for truncated ID {match[2]}")
+      return (None, None, None)
+    # Use full name instead
+    newName = _sanitizeTitle(title)
+
+  createdTime = _parsePropertyTime(properties, _createdPropertyNames)
+  lastEditedTime = _parsePropertyTime(properties, _lastEditedPropertyNames)
+  if not lastEditedTime and os.path.isfile(mdPath):
+    lastEditedTime = datetime.fromtimestamp(os.path.getmtime(mdPath))
+  if not createdTime:
+    createdTime = lastEditedTime
+
+  return (newName, createdTime, lastEditedTime)
+
+def _isOutsideExport(path):
+  """
+  Whether a path rooted at the root of an export points outside of it, like links to
+  "../something" from a top-level page
+  @param {string} path The path, normalized with os.path.normpath
+  """
+  return os.path.isabs(path) or path.split(os.sep)[0] == os.pardir
+
 class NotionExportRenamer:
   """
   Holds state information for renaming a single Notion.so export. Allows it to avoid
   naming collisions and store other state
   """
-  def __init__(self, notionClient, rootPath):
+  def __init__(self, notionClient, rootPath, noApi=False, jobs=1, maxPrefetches=64):
     self.notionClient = notionClient
     self.rootPath = rootPath
+    # Resolve names from the export itself, only querying Notion with notionClient
+    # (if there is one) for the names that can't be resolved that way
+    self.noApi = noApi
     # Dict containing all the paths we've renamed and what they were renamed to
     # (plus createdtime and lastEditedTime). Strings with relative directories to
     # rootPath mapped to 3 tuples returned from noteNameRewrite
@@ -104,6 +218,129 @@ class NotionExportRenamer:
     # renamed mapped to True. Used to see if other files in the folder might
     # have the same name and to act accordingly
     self._collisionCache = {}
+    # Dict containing unrenamed folder paths mapped to True for folders that had
+    # all of their entries renamed already
+    self._resolvedDirCache = {}
+    # Dict containing unrenamed paths mapped to a Future of the 3 tuple of the looked
+    # up name (before handling collisions) and times. Lets other threads look names
+    # up ahead of time, so it's only accessed with _lookupLock
+    self._lookupCache = {}
+    self._lookupLock = threading.Lock()
+    # Threads to look names up on with prefetchWithNotion, None to look them up on the
+    # calling thread. Shut down with close()
+    self._lookupExecutor = concurrent.futures.ThreadPoolExecutor(jobs, thread_name_prefix="NotionLookup") \
+      if jobs > 1 else None
+    # Slots for lookups started by prefetchWithNotion that haven't finished yet, so
+    # prefetching blocks instead of queueing up the whole export on _lookupExecutor
+    self._prefetchSlots = threading.BoundedSemaphore(maxPrefetches)
+    self._closed = False
+
+  def close(self):
+    """
+    Stops the threads looking up names, cancelling the lookups that haven't started
+    and waiting for the ones that have
+    """
+    self._closed = True
+    if self._lookupExecutor:
+      self._lookupExecutor.shutdown(wait=True)
+
+  def dirEntriesInRenameOrder(self, dirPath):
+    """
+    Lists the entries of a folder on disk in the order they're renamed in (files then
+    folders, each sorted)
+    @param {string} dirPath The unrenamed path to the folder, rooted at self.rootPath
+    @returns {list} The paths of the entries rooted at self.rootPath, None if the
+    folder isn't on disk
+    """
+    realDirPath = os.path.join(self.rootPath, dirPath)
+    try:
+      names = os.listdir(realDirPath)
+    except OSError:
+      return None
+    files = sorted([n for n in names if not os.path.isdir(os.path.join(realDirPath, n))])
+    dirs = sorted([n for n in names if os.path.isdir(os.path.join(realDirPath, n))])
+    return [os.path.join(dirPath, name) for name in files + dirs]
+
+  def _resolveDir(self, dirPath):
+    """
+    Renames every entry of a folder on disk in a fixed order so which name gets a
+    collision suffix only depends on the export itself and not on which paths were
+    asked for first (like with links and shards)
+    @param {string} dirPath The unrenamed path to the folder, rooted at self.rootPath
+    """
+    if dirPath in self._resolvedDirCache:
+      return
+    self._resolvedDirCache[dirPath] = True
+    if dirPath and _isOutsideExport(os.path.normpath(dirPath)):
+      return # Never list folders outside the export
+    entryPaths = self.dirEntriesInRenameOrder(dirPath)
+    if entryPaths is None:
+      return # Not on disk (like a broken link), rename on demand instead
+    # Start all the lookups before waiting on any of them
+    for entryPath in entryPaths:
+      self.prefetchWithNotion(entryPath)
+    for entryPath in entryPaths:
+      self.renameAndTimesWithNotion(entryPath)
+
+  def _lookupFuture(self, pathToRename, inBackground=False):
+    """
+    Gets the Future for looking up the name and times of _just the basename_ of a path,
+    starting the lookup if nothing else has started it yet
+    @param {string} pathToRename The unrenamed path, rooted at self.rootPath
+    @param {bool} [inBackground=False] Start the lookup on self._lookupExecutor (if there
+    is one) instead of doing it on this thread
+    """
+    with self._lookupLock:
+      future = self._lookupCache.get(pathToRename)
+      if future is not None:
+        return future
+      future = concurrent.futures.Future()
+      self._lookupCache[pathToRename] = future
+
+    if inBackground and self._lookupExecutor:
+      self._prefetchSlots.acquire()
+      self._lookupExecutor.submit(self._prefetch, pathToRename, future)
+    else:
+      self._lookup(pathToRename, future)
+    return future
+
+  def _prefetch(self, pathToRename, future):
+    """
+    Runs on _lookupExecutor, does _lookup and frees up the prefetch slot it took
+    """
+    try:
+      self._lookup(pathToRename, future)
+    finally:
+      self._prefetchSlots.release()
+
+  def _lookup(self, pathToRename, future):
+    """
+    Looks up the name and times of _just the basename_ of a path into future
+    """
+    if self._closed:
+      future.cancel()
+      return
+    path, name = os.path.split(pathToRename)
+    nameNoExt = os.path.splitext(name)[0]
+    try:
+      newNameNoExt, createdTime, lastEditedTime = (None, None, None)
+      if self.noApi:
+        newNameNoExt, createdTime, lastEditedTime = noteNameRewriteFromExport(self.rootPath, os.path.join(path, nameNoExt))
+      if not newNameNoExt and self.notionClient:
+        newNameNoExt, createdTime, lastEditedTime = noteNameRewrite(self.notionClient, nameNoExt)
+      future.set_result((newNameNoExt, createdTime, lastEditedTime))
+    except Exception as e: # pylint: disable=broad-except
+      future.set_exception(e)
+
+  def prefetchWithNotion(self, pathToRename):
+    """
+    Looks up the name and times for _just the basename_ of a path ahead of time, so
+    renaming it later doesn't have to wait for it. With jobs > 1 it only waits for a
+    free slot when maxPrefetches lookups are already going, not for the lookup itself.
+    Safe to call from any thread, errors are raised when it's renamed instead
+    @param {string} pathToRename The unrenamed path, rooted at self.rootPath
+    """
+    self._lookupFuture(pathToRename, inBackground=True)
 
   def renameAndTimesWithNotion(self, pathToRename):
     """
@@ -114,12 +351,15 @@ class NotionExportRenamer:
     actual unrenamed file/folder on disk rooted at self.rootPath so we can scan around it
     @returns {tuple} 3 tuple of new name, created time and modified time
     """
+    if pathToRename in self._renameCache:
+      return self._renameCache[pathToRename]
+    self._resolveDir(os.path.dirname(pathToRename))
     if pathToRename in self._renameCache:
       return self._renameCache[pathToRename]
 
     path, name = os.path.split(pathToRename)
     nameNoExt, ext = os.path.splitext(name)
-    newNameNoExt, createdTime, lastEditedTime = noteNameRewrite(self.notionClient, nameNoExt)
+    newNameNoExt, createdTime, lastEditedTime = self._lookupFuture(pathToRename).result()
     if not newNameNoExt: # No rename happened, probably no ID in the name or not an .md file
       self._renameCache[pathToRename] = (name, None, None)
     else:
@@ -159,8 +399,15 @@ class NotionExportRenamer:
     """
     Renames all parts of a path
     @param {string} pathToRename A real path on disk to a file or folder root at
-    self.rootPath. All pieces of the path will be renamed
+    self.rootPath. All pieces of the path will be renamed. Paths outside of
+    self.rootPath are returned as is
     """
+    if pathToRename:
+      # Normalize so paths through ".." share renames with the paths they point at
+      normPathToRename = os.path.normpath(pathToRename)
+      if _isOutsideExport(normPathToRename):
+        return pathToRename
+      pathToRename = normPathToRename
     pathToRenameSplit = re.split(r"[\\/]", pathToRename)
     paths = [os.path.join(*pathToRenameSplit[0:rpc + 1]) for rpc in range(len(pathToRenameSplit))]
     return os.path.join(*[self.renameWithNotion(rp) for rp in paths])
@@ -176,7 +423,136 @@ class NotionExportRenamer:
     newName, createdTime, lastEditedTime = self.renameAndTimesWithNotion(pathToRename)
     return (os.path.join(newPath, newName), createdTime, lastEditedTime)
 
-def mdFileRewrite(renamer, mdFilePath, mdFileContents=None, removeTopH1=False, rewritePaths=False):
+# Patterns for mdLinkTargetSpans, none of them can backtrack past the end of a line or tag
+_mdReferenceTargetPattern = re.compile(r"[ \t]*(?:<([^>\n]+)>|(\S+))")
+_htmlImgTagPattern = re.compile(r"<img[\s/]", re.IGNORECASE)
+_htmlSrcAttributePattern = re.compile(r"\ssrc[ \t]*=[ \t]*(?:\"([^\"]*)\"|'([^']*)')", re.IGNORECASE)
+
+def _isLineStart(text, index):
+  """
+  Whether index in text is at the start of a line, allowing up to 3 spaces of
+  indentation like Markdown does
+  """
+  spaces = 0
+  while index > 0 and text[index - 1] == " " and spaces < 3:
+    index -= 1
+    spaces += 1
+  return index == 0 or text[index - 1] == "\n"
+
+def _mdLabelKey(label):
+  """
+  Normalizes a Markdown link label the way matching them does, case insensitive and
+  with runs of whitespace collapsed
+  """
+  return " ".join(label.split()).lower()
+
+def mdLinkTargetSpans(mdText, isUnusedDefinitionTarget=None):
+  """
+  Finds the targets of all the links and images in Markdown text. Guaranteed linear
+  time, every character is only looked at a constant number of times, so there's no
+  regex backtracking on long lines with unbalanced brackets
+  * Inline links and images, `[text](target)` and `![alt](target)`, with balanced
+    parentheses in the target and `<target>` style targets. Targets followed by a
+    title (`[text](target "title")`) aren't found, Notion doesn't export titles
+  * Reference definitions, `[label]: target`, when the label is used by a
+    `[text][label]` or `[label]` link. Any line starting with `[something]:` looks like
+    one, so unused ones are usually just text
+  * `<img src="target">` tags
+  * Backslash escaped brackets and parentheses are skipped, and left escaped in the
+    targets (unescape them before use)
+  @param {string} mdText The Markdown text
+  @param {function} [isUnusedDefinitionTarget=None] Takes the target of a reference
+  definition whose label isn't used and returns if it should be found anyways. Defaults
+  to never finding them
+  @returns {list} Sorted list of non-overlapping 2 tuples of start and end index of
+  every target in mdText
+  """
+  # Pair up brackets on the same line and parentheses in the same run of
+  # non-whitespace, which is all link text and link targets can span
+  bracketPairs = [] # 2 tuples of [ and ] index, in order of the ]
+  parenCloses = {} # ( index mapped to the index of the matching )
+  bracketStack = []
+  parenStack = []
+  for m in re.finditer(r"\\.|[\[\]()\s]", mdText):
+    c = m[0]
+    if c == "[":
+      bracketStack.append(m.start())
+    elif c == "]" and bracketStack:
+      bracketPairs.append((bracketStack.pop(), m.start()))
+    elif c == "(":
+      parenStack.append(m.start())
+    elif c == ")" and parenStack:
+      parenCloses[parenStack.pop()] = m.start()
+    elif c.isspace():
+      parenStack = []
+      if c == "\n":
+        bracketStack = []
+    # Anything else is escaped, so not special
+
+  # str.find() for increasing start indexes that doesn't rescan text it already
+  # scanned, keeping the whole thing linear
+  lastFinds = {}
+  def findNext(char, start):
+    lastStart, lastFound = lastFinds.get(char, (None, None))
+    if lastStart is not None and start >= lastStart and (lastFound == -1 or lastFound >= start):
+      return lastFound
+    found = mdText.find(char, start)
+    lastFinds[char] = (start, found)
+    return found
+
+  # Labels used by reference links, [text][label] and [label]. Labels can be at most
+  # 999 characters, so nested brackets can't make this quadratic
+  usedLabels = set()
+  for openIndex, closeIndex in bracketPairs:
+    if closeIndex - openIndex <= 1000 and not mdText.startswith(("(", ":"), closeIndex + 1):
+      usedLabels.add(_mdLabelKey(mdText[openIndex + 1:closeIndex]))
+
+  spans = []
+  for openIndex, closeIndex in bracketPairs:
+    afterIndex = closeIndex + 1
+    if mdText.startswith("(<", afterIndex):
+      targetEnd = findNext(">", afterIndex + 2)
+      lineEnd = findNext("\n", afterIndex + 2)
+      if targetEnd > afterIndex + 2 and (lineEnd == -1 or targetEnd < lineEnd) and \
+        mdText.startswith(")", targetEnd + 1):
+        spans.append((afterIndex + 2, targetEnd))
+    elif mdText.startswith("(", afterIndex):
+      if parenCloses.get(afterIndex, afterIndex) > afterIndex + 1:
+        spans.append((afterIndex + 1, parenCloses[afterIndex]))
+    elif mdText.startswith(":", afterIndex) and _isLineStart(mdText, openIndex) and \
+      not mdText.startswith("[^", openIndex): # [^label]: is a footnote
+      # Only one per line, so scanning to the end of the target is linear too
+      targetMatch = _mdReferenceTargetPattern.match(mdText, afterIndex + 1)
+      if targetMatch:
+        group = 1 if targetMatch[1] else 2
+        if _mdLabelKey(mdText[openIndex + 1:closeIndex]) in usedLabels or \
+          (isUnusedDefinitionTarget and isUnusedDefinitionTarget(targetMatch[group])):
+          spans.append((targetMatch.start(group), targetMatch.end(group)))
+
+  # <img> tags, each one is only scanned once
+  searchIndex = 0
+  while True:
+    tagMatch = _htmlImgTagPattern.search(mdText, searchIndex)
+    if not tagMatch:
+      break
+    tagEnd = mdText.find(">", tagMatch.end())
+    if tagEnd == -1:
+      break # No more tags can be closed
+    searchIndex = tagEnd + 1
+    srcMatch = _htmlSrcAttributePattern.search(mdText, tagMatch.end() - 1, tagEnd)
+    if srcMatch:
+      group = 1 if srcMatch[1] is not None else 2
+      if srcMatch.end(group) > srcMatch.start(group):
+        spans.append((srcMatch.start(group), srcMatch.end(group)))
+
+  # Drop targets inside of other targets (like "[a](b[c](d))")
+  nonOverlappingSpans = []
+  for span in sorted(spans):
+    if not nonOverlappingSpans or span[0] >= nonOverlappingSpans[-1][1]:
+      nonOverlappingSpans.append(span)
+  return nonOverlappingSpans
+
+def mdFileRewrite(renamer, mdFilePath, mdFileContents=None, removeTopH1=False, rewritePaths=False, duplicatePaths=None):
   """
   Takes a Notion exported md file and rewrites parts of it
   @param {string} mdFilePath String to the markdown file that's being editted, rooted at
@@ -186,6 +562,8 @@ def mdFileRewrite(renamer, mdFilePath, mdFileContents=None, removeTopH1=False, r
   @param {boolean} [removeTopH1=False] Remove the title on the first line of the MD file?
   @param {boolean} [rewritePaths=False] Rewrite the relative paths in the MD file (images and links)
   using Notion file name rewriting
+  @param {dict} [duplicatePaths=None] Paths of duplicate files mapped to the path of the copy that
+  was kept, all rooted at self.rootPath. Rewritten links to duplicates will point at the kept copy
   """
   if not mdFileContents:
     raise NotImplementedError("TODO: Not passing mdFileContents is not implemented... please pass it ;w;")
@@ -199,23 +577,40 @@ def mdFileRewrite(renamer, mdFilePath, mdFileContents=None, removeTopH1=False, r
     # Notion link/images use relative paths to other notes, which we can't known without
     # consulting the file tree and renaming (to handle duplicates and such)
     # Notion links are also URL encoded
-    # Can't use finditer because we modify the string each time...
-    searchStartIndex = 0
-    while True:
-      m = re.search(r"!?\[.+?\]\(([\w\d\-._~:/?=#%\]\[@!$&'\(\)*+,;]+?)\)", newMDFileContents[searchStartIndex:])
-      if not m:
-        break
+    mdDirPath = os.path.dirname(mdFilePath)
+    def targetToPath(target):
+      if re.match(r"[A-Za-z][A-Za-z0-9+.-]*:", target):
+        return None # Has a URI scheme (https:, mailto:, data:, etc), not a local file path
+      # Markdown backslash escapes come before URL encoding
+      relTargetFilePath = urllib.parse.unquote(re.sub(r"\\([!-/:-@\[-`{-~])", r"\1", target))
+      if os.path.isabs(relTargetFilePath):
+        return None # Not relative to anything in the export
+      return relTargetFilePath
+    def isExportPath(target):
+      # Lines that only look like reference definitions are text, unless they happen to
+      # point at a file in the export
+      relTargetFilePath = targetToPath(target)
+      if relTargetFilePath is None:
+        return False
+      targetFilePath = os.path.normpath(os.path.join(mdDirPath, relTargetFilePath))
+      return not _isOutsideExport(targetFilePath) and os.path.exists(os.path.join(renamer.rootPath, targetFilePath))
 
-      if re.search(r":/", m.group(1)):
-        searchStartIndex = searchStartIndex + m.end(1)
-        continue # Not a local file path
-      relTargetFilePath = urllib.parse.unquote(m.group(1))
+    newMDDirPath = None
+    newMDFileParts = []
+    lastEnd = 0
+    for start, end in mdLinkTargetSpans(newMDFileContents, isUnusedDefinitionTarget=isExportPath):
+      relTargetFilePath = targetToPath(newMDFileContents[start:end])
+      if relTargetFilePath is None:
+        continue
 
       # Convert the current MD file path and link target path to the renamed version
       # (also taking into account potentially mdFilePath renames moving the directory)
-      mdDirPath = os.path.dirname(mdFilePath)
-      newTargetFilePath = renamer.renamePathWithNotion(os.path.join(mdDirPath, relTargetFilePath))
-      newMDDirPath = os.path.dirname(renamer.renamePathWithNotion(mdFilePath))
+      targetFilePath = os.path.join(mdDirPath, relTargetFilePath)
+      if duplicatePaths:
+        targetFilePath = duplicatePaths.get(os.path.normpath(targetFilePath), targetFilePath)
+      newTargetFilePath = renamer.renamePathWithNotion(targetFilePath)
+      if newMDDirPath is None:
+        newMDDirPath = os.path.dirname(renamer.renamePathWithNotion(mdFilePath))
       # Find the relative path to the newly converted paths for both files
       newRelTargetFilePath = os.path.relpath(newTargetFilePath, newMDDirPath)
       # Convert back to the way markdown expects the link to be
@@ -224,12 +619,464 @@ def mdFileRewrite(renamer, mdFilePath, mdFileContents=None, removeTopH1=False, r
 
       # Replace the path in the original string with the new relative renamed
       # target path
-      newMDFileContents = newMDFileContents[0:m.start(1) + searchStartIndex] + newRelTargetFilePath + newMDFileContents[m.end(1) + searchStartIndex:]
-      searchStartIndex = searchStartIndex + m.start(1) + len(newRelTargetFilePath)
+      newMDFileParts.append(newMDFileContents[lastEnd:start])
+      newMDFileParts.append(newRelTargetFilePath)
+      lastEnd = end
+    newMDFileParts.append(newMDFileContents[lastEnd:])
+    newMDFileContents = "".join(newMDFileParts)
 
   return newMDFileContents
 
-def rewriteNotionZip(notionClient, zipPath, outputPath=".", removeTopH1=False, rewritePaths=True):
+def _shardKey(relPath):
+  """
+  Gets the key of the top-level subtree a path in a Notion export belongs to. A
+  top-level .md file shares the key of the folder for its children so they always
+  end up in the same shard
+  @param {string} relPath Path rooted at the root of the export
+  @returns {string} The shard key
+  """
+  topName = re.split(r"[\\/]", relPath)[0]
+  if topName.endswith(".md"):
+    topName = topName[:-len(".md")]
+  return topName
+
+def planNotionZipShards(zipPath, shardCount):
+  """
+  Splits the top-level subtrees of a Notion .zip into shards of about the same
+  uncompressed size. Only depends on the .zip itself so every process or machine
+  working on the same .zip gets the same plan
+  @param {string} zipPath The path to the Notion zip
+  @param {int} shardCount How many shards to split into
+  @returns {list} List of shardCount sets of shard keys (see _shardKey)
+  """
+  keySizes = {}
+  with zipfile.ZipFile(zipPath) as zf:
+    for zi in zf.infolist():
+      key = _shardKey(zi.filename)
+      keySizes[key] = keySizes.get(key, 0) + zi.file_size
+
+  # Biggest subtrees first, each into the currently smallest shard
+  shards = [set() for _ in range(shardCount)]
+  shardSizes = [0] * shardCount
+  for key in sorted(keySizes, key=lambda k: (-keySizes[k], k)):
+    smallestShard = shardSizes.index(min(shardSizes))
+    shards[smallestShard].add(key)
+    shardSizes[smallestShard] += keySizes[key]
+  return shards
+
+def shardZipPath(newZipPath, shardIndex, shardCount):
+  """
+  Gets the path a single shard of newZipPath is written to
+  """
+  return f"{newZipPath}.{shardIndex}-of-{shardCount}"
+
+def _zipEntryDataOffset(f, zi):
+  """
+  Gets where the (compressed) data of an entry starts in the file of a zip, skipping
+  over the local header as its name and extra can differ from the central directory's
+  @param {file} f The zip file, opened in binary mode
+  @param {ZipInfo} zi The entry
+  @returns {int} Offset in f
+  """
+  f.seek(zi.header_offset)
+  localHeader = f.read(zipfile.sizeFileHeader)
+  nameLength, extraLength = struct.unpack("<HH", localHeader[26:30])
+  return zi.header_offset + zipfile.sizeFileHeader + nameLength + extraLength
+
+def _stripZip64Extra(extra):
+  """
+  Removes the Zip64 field from the extra data of a ZipInfo, as zipfile adds its own
+  whenever one is needed
+  @param {bytes} extra The extra data, a sequence of 2 byte ID, 2 byte size and data fields
+  @returns {bytes} extra without any Zip64 field
+  """
+  fields = []
+  i = 0
+  while i + 4 <= len(extra):
+    fieldId, fieldSize = struct.unpack("<HH", extra[i:i + 4])
+    if fieldId != 1:
+      fields.append(extra[i:i + 4 + fieldSize])
+    i += 4 + fieldSize
+  return b"".join(fields)
+
+def _zipFileInternals(zf, attributes):
+  """
+  Checks that an open ZipFile has the undocumented attributes raw copies need. zipfile
+  has no API for them, so everything that uses them checks with this first. They're
+  the same from Python 3.6 to 3.13: fp is the zip's file, start_dir is where the next
+  entry goes, and close() writes the central directory from filelist when _didModify
+  is set
+  @param {ZipFile} zf The ZipFile
+  @param {list} attributes The names of the attributes that will be used
+  @returns {file} zf.fp
+  """
+  missing = [a for a in attributes if not hasattr(zf, a)]
+  if missing:
+    raise RuntimeError(f"zipfile in Python {sys.version.split()[0]} is missing {', '.join(missing)}, which are needed to copy compressed entries")
+  if getattr(zf, "_writing", False):
+    raise ValueError("Can't copy compressed entries while another entry is being written to the zip")
+  return zf.fp
+
+def _appendRawZipEntry(zf, zi, writeData):
+  """
+  Appends an entry with already compressed data to a ZipFile opened for writing
+  @param {ZipFile} zf The ZipFile to append to
+  @param {ZipInfo} zi The ZipInfo of the entry, with its compression info filled in
+  @param {function} writeData Takes the offset in the zip's file to write the compressed
+  data at, writes it and returns the offset just after it
+  """
+  f = _zipFileInternals(zf, ["fp", "start_dir", "_didModify", "_writing", "filelist", "NameToInfo"])
+  zi.flag_bits &= ~0x08 # Sizes go in the local header, there's no data descriptor
+  zi.header_offset = zf.start_dir
+  zip64 = zi.file_size > zipfile.ZIP64_LIMIT or zi.compress_size > zipfile.ZIP64_LIMIT
+  f.seek(zi.header_offset)
+  f.write(zi.FileHeader(zip64))
+  endOffset = writeData(f, f.tell())
+
+  zf.filelist.append(zi)
+  zf.NameToInfo[zi.filename] = zi
+  zf.start_dir = endOffset
+  zf._didModify = True
+
+def _copyRawZipEntry(srcZf, zi, dstZf, newZi=None):
+  """
+  Copies an entry from one open ZipFile to the end of another (or the same one)
+  without decompressing and recompressing it
+  @param {ZipFile} srcZf The ZipFile to copy from, opened for reading or writing
+  @param {ZipInfo} zi The entry in srcZf to copy
+  @param {ZipFile} dstZf The ZipFile to copy to, opened for writing
+  @param {ZipInfo} [newZi=None] The ZipInfo to use for the copy (name, time, etc), with
+  the compression info taken from zi. Defaults to a copy of zi
+  """
+  srcF = _zipFileInternals(srcZf, ["fp"])
+  readOffset = _zipEntryDataOffset(srcF, zi)
+
+  if newZi is None:
+    newZi = copy.copy(zi)
+    newZi.extra = _stripZip64Extra(zi.extra)
+  else:
+    newZi.compress_type = zi.compress_type
+    newZi.CRC = zi.CRC
+    newZi.compress_size = zi.compress_size
+    newZi.file_size = zi.file_size
+    newZi.flag_bits = zi.flag_bits
+
+  def writeData(dstF, writeOffset):
+    # Seek every chunk, srcZf and dstZf might share the same file
+    nonlocal readOffset
+    remaining = zi.compress_size
+    while remaining > 0:
+      srcF.seek(readOffset)
+      chunk = srcF.read(min(remaining, 1024 * 1024))
+      dstF.seek(writeOffset)
+      dstF.write(chunk)
+      readOffset += len(chunk)
+      writeOffset += len(chunk)
+      remaining -= len(chunk)
+    return writeOffset
+
+  _appendRawZipEntry(dstZf, newZi, writeData)
+
+# Name of the manifest entry in the output zip. It's a tab separated file with a header
+# line and then a line for every file in the export sorted by key, the Notion ID of the
+# file (or for files without one, the original path)
+manifestEntryName = ".enhancer-manifest.tsv"
+manifestColumns = ["key", "originalPath", "newPath", "sha256", "createdTime", "lastEditedTime"]
+_manifestTimeFormat = "%Y-%m-%dT%H:%M:%S.%f"
+
+def _escapeManifestField(field):
+  """
+  Escapes a manifest field so it never contains the tabs and newlines between fields
+  """
+  return field.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def manifestLine(relPath, newPath, contentHash, createdTime, lastEditedTime):
+  """
+  Makes the manifest line for a file in the export
+  @param {string} relPath The original path of the file, rooted at the root of the export
+  @param {string} newPath The path of the file in the output zip
+  @param {string} contentHash The hex SHA-256 of the content in the output zip
+  @param {datetime} createdTime Created time of the file, or None
+  @param {datetime} lastEditedTime Last edited time of the file, or None
+  @returns {string} The line, with a trailing newline
+  """
+  nameNoExt = os.path.splitext(os.path.basename(relPath))[0]
+  match = re.search(r" ([0-9a-f]{32})$", nameNoExt)
+  originalPath = relPath.replace(os.sep, "/")
+  fields = [match[1] if match else originalPath, originalPath, newPath, contentHash or "",
+    createdTime.strftime(_manifestTimeFormat) if createdTime else "",
+    lastEditedTime.strftime(_manifestTimeFormat) if lastEditedTime else ""]
+  return "\t".join([_escapeManifestField(f) for f in fields]) + "\n"
+
+def _manifestLineSortKey(line):
+  """
+  Sort key for manifest lines. The binary search in lookupManifest only compares the
+  key field, so lines are sorted by that first (then by the whole line so the order
+  is always the same)
+  """
+  return (line.split("\t", 1)[0], line)
+
+def _parseManifestLine(line):
+  """
+  Parses a line of the manifest back into a dict of manifestColumns to their values,
+  with the times as datetimes (or None)
+  """
+  fields = [re.sub(r"\\(.)", lambda m: {"t": "\t", "n": "\n"}.get(m[1], m[1]), f) \
+    for f in line.rstrip("\n").split("\t")]
+  row = dict(zip(manifestColumns, fields))
+  for column in ["createdTime", "lastEditedTime"]:
+    row[column] = datetime.strptime(row[column], _manifestTimeFormat) if row[column] else None
+  return row
+
+def writeManifest(zf, manifestLines):
+  """
+  Writes the manifest as an uncompressed entry at the end of a zip, so it can be
+  searched in place (see lookupManifest)
+  @param {ZipFile} zf The ZipFile to write to
+  @param {iterable} manifestLines Lines from manifestLine, already sorted with
+  _manifestLineSortKey
+  """
+  zi = zipfile.ZipInfo(manifestEntryName)
+  zi.compress_type = zipfile.ZIP_STORED
+  zf.writestr(zi, "\t".join(manifestColumns) + "\n" + "".join(manifestLines))
+
+def _readManifestLines(zf):
+  """
+  Reads all the lines of the manifest of an open ZipFile, without the header line
+  """
+  # Only split on "\n" like lookupManifest, other line breaks aren't escaped in fields
+  return [line + "\n" for line in zf.read(manifestEntryName).decode('utf-8').split("\n")[1:-1]]
+
+def lookupManifest(zipPath, key):
+  """
+  Looks up entries in the manifest of a zip written by rewriteNotionZip. Binary searches
+  the manifest in place, so the rest of the zip is never read
+  @param {string} zipPath The path to the output zip
+  @param {string} key The Notion ID to look up, or original path (with "/") for files without one
+  @returns {list} A dict of manifestColumns to their values for every matching entry
+  """
+  targetKey = _escapeManifestField(key).encode('utf-8')
+  with zipfile.ZipFile(zipPath) as zf:
+    zi = zf.getinfo(manifestEntryName)
+    if zi.compress_type != zipfile.ZIP_STORED:
+      # Recompressed by something else, so it can't be searched in place
+      return [_parseManifestLine(line) for line in _readManifestLines(zf) \
+        if line.split("\t", 1)[0].encode('utf-8') == targetKey]
+  with open(zipPath, "rb") as f:
+    dataOffset = _zipEntryDataOffset(f, zi)
+    end = dataOffset + zi.file_size
+    f.seek(dataOffset)
+    f.readline() # Skip the header line
+    lo = f.tell() # Every line before lo has a smaller key
+    hi = end
+    while lo < hi:
+      mid = (lo + hi) // 2
+      f.seek(mid)
+      if mid > lo:
+        f.readline() # To the start of the next line
+      if f.tell() >= hi:
+        hi = mid
+        continue
+      line = f.readline()
+      if line.split(b"\t", 1)[0] < targetKey:
+        lo = f.tell()
+      else:
+        hi = mid
+
+    rows = []
+    f.seek(lo)
+    while f.tell() < end:
+      line = f.readline()
+      lineKey = line.split(b"\t", 1)[0]
+      if lineKey > targetKey:
+        break
+      if lineKey == targetKey:
+        rows.append(_parseManifestLine(line.decode('utf-8')))
+  return rows
+
+def mergeNotionZipShards(shardZipPaths, newZipPath):
+  """
+  Combines the outputs of rewriteNotionZip for every shard of an export into a
+  single zip, copying the already compressed entries as-is
+  @param {list} shardZipPaths The paths to the zip of every shard
+  @param {string} newZipPath The path of the combined zip to write
+  @returns {string} Path to the output zip file
+  """
+  with zipfile.ZipFile(newZipPath, 'w', zipfile.ZIP_DEFLATED) as zf:
+    shardManifestLines = []
+    mergedNames = set()
+    for shardPath in shardZipPaths:
+      print(f"Merging '{shardPath}'")
+      with zipfile.ZipFile(shardPath) as shardZf:
+        for zi in shardZf.infolist():
+          if zi.filename == manifestEntryName:
+            shardManifestLines.append(_readManifestLines(shardZf))
+            continue # Combined after everything else
+          if zi.filename in mergedNames:
+            raise ValueError(f"'{zi.filename}' is in more than one shard, were the shards made from the same export?")
+          mergedNames.add(zi.filename)
+          _copyRawZipEntry(shardZf, zi, zf)
+    if shardManifestLines:
+      writeManifest(zf, heapq.merge(*shardManifestLines, key=_manifestLineSortKey))
+  return newZipPath
+
+def _walkExport(rootPath):
+  """
+  Walks all the files of an extracted Notion export
+  @param {string} rootPath The path the export was extracted to
+  @returns {generator} Yields 2 tuples of the path on disk and the path rooted at rootPath
+  """
+  for walkDirPath, dirs, files in os.walk(rootPath):
+    walkDir = os.path.relpath(walkDirPath, rootPath)
+    for name in files:
+      realPath = os.path.join(walkDirPath, name)
+      relPath = os.path.join("" if walkDir == "." else walkDir, name) # Prevent paths starting with .\\ which, when written to the tar, do annoying things
+      yield (realPath, relPath)
+
+def _hashFile(filePath):
+  """
+  Hashes the content of a file, reading it in chunks
+  @returns {string} The hex SHA-256 of the file
+  """
+  h = hashlib.sha256()
+  with open(filePath, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+def _isAttachmentPath(relPath):
+  """
+  Whether a path in a Notion export is an attachment (images, PDFs, etc) inside of a
+  page's folder, and not something Notion exported itself (pages, databases and
+  anything else named with a Notion ID)
+  @param {string} relPath Path rooted at the root of the export
+  """
+  nameNoExt, ext = os.path.splitext(os.path.basename(relPath))
+  return os.path.dirname(relPath) != "" and ext not in [".md", ".csv"] and \
+    not re.search(r" [0-9a-f]{32}$", nameNoExt)
+
+def findDuplicateAttachments(rootPath):
+  """
+  Finds attachments (see _isAttachmentPath) in an extracted Notion export that have the
+  same content as another one. Databases and pages are never deduped, even empty ones
+  are different tables
+  @param {string} rootPath The path the export was extracted to
+  @returns {tuple} 2 tuple of a dict of the path of every attachment mapped to the hash of
+  its content and a dict of the paths of duplicates mapped to the path of the copy to keep
+  (the first path, sorted), all paths rooted at rootPath
+  """
+  attachmentHashes = {}
+  for realPath, relPath in _walkExport(rootPath):
+    if _isAttachmentPath(relPath):
+      attachmentHashes[relPath] = _hashFile(realPath)
+
+  keptPaths = {}
+  duplicatePaths = {}
+  for relPath in sorted(attachmentHashes):
+    contentHash = attachmentHashes[relPath]
+    if contentHash in keptPaths:
+      duplicatePaths[relPath] = keptPaths[contentHash]
+    else:
+      keptPaths[contentHash] = relPath
+  return (attachmentHashes, duplicatePaths)
+
+def _runPipeline(renamer, exportFiles, rewriteFile, writeFile, queueSize=64):
+  """
+  Rewrites the files of an export with each stage on its own thread, connected by
+  bounded queues, so local work doesn't wait on Notion and Notion doesn't wait on
+  compression. Scanning starts looking up the names of every folder it gets to on the
+  renamer's threads, at most the renamer's maxPrefetches at a time, and rewriting and
+  writing the zip each go through the files in order, so the output is the same as
+  doing it all on one thread
+  @param {NotionExportRenamer} renamer The renamer to look up names ahead of time with,
+  created with jobs > 1
+  @param {iterable} exportFiles 2 tuples of path on disk and path rooted at the root of
+  the export of the files to rewrite, in order
+  @param {function} rewriteFile Takes the 2 tuple from exportFiles and returns what to
+  write, or None to skip it
+  @param {function} writeFile Takes what rewriteFile returned and writes it
+  @param {int} [queueSize=64] How many items each queue holds before blocking
+  """
+  rewriteQueue = queue.Queue(queueSize)
+  writeQueue = queue.Queue(queueSize)
+  stopEvent = threading.Event() # Set when any stage fails, so the others stop
+  errors = []
+
+  def put(q, item):
+    while not stopEvent.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def get(q):
+    while not stopEvent.is_set():
+      try:
+        return q.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    return None
+
+  def fail(e):
+    errors.append(e)
+    stopEvent.set()
+
+  def scan():
+    try:
+      scannedDirPaths = set()
+      for realPath, relPath in exportFiles:
+        if stopEvent.is_set():
+          break
+        # Every entry of a folder is renamed at once, so look them all up (folders
+        # closest to the root first). Folders that links point to that scanning hasn't
+        # gotten to yet are looked up all at once when they're renamed
+        newDirPaths = []
+        dirPath = os.path.dirname(relPath)
+        while dirPath not in scannedDirPaths:
+          scannedDirPaths.add(dirPath)
+          newDirPaths.append(dirPath)
+          dirPath = os.path.dirname(dirPath)
+        for dirPath in reversed(newDirPaths):
+          for entryPath in renamer.dirEntriesInRenameOrder(dirPath) or []:
+            renamer.prefetchWithNotion(entryPath)
+        put(rewriteQueue, (realPath, relPath))
+    except Exception as e: # pylint: disable=broad-except
+      fail(e)
+    finally:
+      put(rewriteQueue, None)
+
+  def rewrite():
+    try:
+      exportFile = get(rewriteQueue)
+      while exportFile is not None:
+        toWrite = rewriteFile(*exportFile)
+        if toWrite:
+          put(writeQueue, toWrite)
+        exportFile = get(rewriteQueue)
+    except Exception as e: # pylint: disable=broad-except
+      fail(e)
+    finally:
+      put(writeQueue, None)
+
+  threads = [threading.Thread(target=t, daemon=True) for t in [scan, rewrite]]
+  for thread in threads:
+    thread.start()
+  # Write on this thread
+  try:
+    toWrite = get(writeQueue)
+    while toWrite is not None:
+      writeFile(toWrite)
+      toWrite = get(writeQueue)
+  except Exception as e: # pylint: disable=broad-except
+    fail(e)
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+
+def rewriteNotionZip(notionClient, zipPath, outputPath=".", removeTopH1=False, rewritePaths=True, noApi=False, shard=None,
+  dedupeAttachments=None, jobs=1, manifest=False):
   """
   Takes a Notion .zip and prettifies the whole thing
   * Removes all Notion IDs from end of names, folders and files
@@ -239,51 +1086,132 @@ def rewriteNotionZip(notionClient, zipPath, outputPath=".", removeTopH1=False, r
   * Fix links inside of files
   * Optionally remove titles at the tops of files
 
-  @param {NotionClient} notionClient The NotionClient to use to query Notion with
+  @param {NotionClient} notionClient The NotionClient to use to query Notion with,
+  can be None with noApi
   @param {string} zipPath The path to the Notion zip
   @param {string} [outputPath="."] Optional output path, otherwise will use cwd
   @param {boolean} [removeTopH1=False] To remove titles at the top of all the md files
   @param {boolean} [rewritePaths=True] To rewrite all the links and images in the Markdown files too
+  @param {boolean} [noApi=False] To resolve names and times from the export itself, only
+  querying Notion for the ones that can't be
+  @param {tuple} [shard=None] 2 tuple of shard index and shard count to only process
+  one shard of the export (see planNotionZipShards). The shard is written to its own
+  file (see shardZipPath) to be combined with mergeNotionZipShards
+  @param {string} [dedupeAttachments=None] What to do with attachments that have the same
+  content as another one. "report" to list them and only compress them once, "collapse"
+  to only write the first one and point links at it instead
+  @param {int} [jobs=1] How many names to look up at the same time. Above 1, looking up names,
+  rewriting files and writing the zip overlap on separate threads, with the same output
+  @param {boolean} [manifest=False] To add a manifest of the Notion ID, original path, new path,
+  content hash and times of every file to the end of the zip (see lookupManifest)
   @returns {string} Path to the output zip file
   """
+  shardKeys = None
+  if shard:
+    shardIndex, shardCount = shard
+    shardKeys = planNotionZipShards(zipPath, shardCount)[shardIndex]
+
   with tempfile.TemporaryDirectory() as tmpDir:
     # Unpack the whole thing first (probably faster than traversing it zipped, like with tar files)
     print(f"Extracting '{zipPath}' temporarily...")
     with zipfile.ZipFile(zipPath) as zf:
-      zf.extractall(tmpDir)
+      for zi in zf.infolist():
+        extractedPath = zf.extract(zi, tmpDir)
+        # Keep the times from the original export for when there's nothing better
+        exportTime = time.mktime(zi.date_time + (0, 0, -1))
+        os.utime(extractedPath, (exportTime, exportTime))
 
     # Make new zip to begin filling
     zipName = os.path.basename(zipPath)
     newZipName = f"{zipName}.formatted"
     newZipPath = os.path.join(outputPath, newZipName)
+    if shard:
+      newZipPath = shardZipPath(newZipPath, shardIndex, shardCount)
+
+    attachmentHashes = {}
+    duplicatePaths = {}
+    if dedupeAttachments:
+      print("Looking for duplicate attachments...")
+      attachmentHashes, duplicatePaths = findDuplicateAttachments(tmpDir)
+      for relPath, keptRelPath in sorted(duplicatePaths.items()):
+        print(f"'{relPath}' is a duplicate of '{keptRelPath}'")
+      duplicateSize = sum([os.path.getsize(os.path.join(tmpDir, p)) for p in duplicatePaths])
+      print(f"Found {len(duplicatePaths)} duplicate attachments, {duplicateSize} bytes")
+
     with zipfile.ZipFile(newZipPath, 'w', zipfile.ZIP_DEFLATED) as zf:
 
       #Traverse over the files, renaming, modifying, and rewriting back to the zip
-      renamer = NotionExportRenamer(notionClient, tmpDir)
-      for tmpWalkDir, dirs, files in os.walk(tmpDir):
-        walkDir = os.path.relpath(tmpWalkDir, tmpDir)
-        for name in files:
-          realPath = os.path.join(tmpWalkDir, name)
-          relPath = os.path.join("" if walkDir == "." else walkDir, name) # Prevent paths starting with .\\ which, when written to the tar, do annoying things
-          # print(f"Reading '{root}' '{name}'")
-
-          # Rewrite the current path and get the times from Notion
-          print("---")
-          print(f"Working on '{relPath}'")
-          newPath, createdTime, lastEditedTime = renamer.renamePathAndTimesWithNotion(relPath)
-
-          if os.path.splitext(name)[1] == ".md":
-            # Grab the data from the file if md file
-            with open(realPath, "r", encoding='utf-8') as f:
-              mdFileData = f.read()
-            mdFileData = mdFileRewrite(renamer, relPath, mdFileContents=mdFileData, removeTopH1=removeTopH1, rewritePaths=rewritePaths)
-
-            print(f"Writing as '{newPath}' with time '{lastEditedTime}'")
-            zi = zipfile.ZipInfo(newPath, lastEditedTime.timetuple())
-            zf.writestr(zi, mdFileData)
+      renamer = NotionExportRenamer(notionClient, tmpDir, noApi=noApi, jobs=jobs)
+      # Hashes of attachment content mapped to the ZipInfo it was first written as
+      writtenAttachments = {}
+      manifestLines = []
+
+      def rewriteFile(realPath, relPath):
+        # Rewrite the current path and get the times from Notion
+        print("---")
+        print(f"Working on '{relPath}'")
+        if dedupeAttachments == "collapse" and relPath in duplicatePaths:
+          print(f"Skipping, links point to '{duplicatePaths[relPath]}' instead")
+          if manifest:
+            keptNewPath = renamer.renamePathWithNotion(duplicatePaths[relPath]).replace(os.sep, "/")
+            manifestLines.append(manifestLine(relPath, keptNewPath, attachmentHashes[relPath], None, None))
+          return None
+        newPath, createdTime, lastEditedTime = renamer.renamePathAndTimesWithNotion(relPath)
+
+        mdFileData = None
+        if os.path.splitext(relPath)[1] == ".md":
+          # Grab the data from the file if md file
+          with open(realPath, "r", encoding='utf-8') as f:
+            mdFileData = f.read()
+          mdFileData = mdFileRewrite(renamer, relPath, mdFileContents=mdFileData, removeTopH1=removeTopH1, rewritePaths=rewritePaths,
+            duplicatePaths=duplicatePaths if dedupeAttachments == "collapse" else None)
+          if not lastEditedTime:
+            print(f"No time found for '{relPath}', using time from original export")
+            lastEditedTime = datetime.fromtimestamp(os.path.getmtime(realPath))
+
+        contentHash = None
+        if manifest:
+          if mdFileData is not None:
+            contentHash = hashlib.sha256(mdFileData.encode('utf-8')).hexdigest()
           else:
-            print(f"Writing as '{newPath}' with time from original export (not an .md file)")
-            zf.write(realPath, newPath)
+            contentHash = attachmentHashes.get(relPath) or _hashFile(realPath)
+        return (realPath, relPath, newPath, createdTime, lastEditedTime, mdFileData, contentHash)
+
+      def writeFile(toWrite):
+        realPath, relPath, newPath, createdTime, lastEditedTime, mdFileData, contentHash = toWrite
+        if mdFileData is not None:
+          print(f"Writing as '{newPath}' with time '{lastEditedTime}'")
+          zi = zipfile.ZipInfo(newPath, lastEditedTime.timetuple())
+          zf.writestr(zi, mdFileData)
+        elif attachmentHashes.get(relPath) in writtenAttachments:
+          print(f"Writing as '{newPath}' with time from original export, copying the already compressed duplicate")
+          _copyRawZipEntry(zf, writtenAttachments[attachmentHashes[relPath]], zf,
+            newZi=zipfile.ZipInfo.from_file(realPath, newPath))
+        else:
+          print(f"Writing as '{newPath}' with time from original export (not an .md file)")
+          zf.write(realPath, newPath)
+          if relPath in attachmentHashes:
+            writtenAttachments[attachmentHashes[relPath]] = zf.infolist()[-1]
+        if manifest:
+          zi = zf.infolist()[-1]
+          manifestLines.append(manifestLine(relPath, zi.filename, contentHash,
+            createdTime, lastEditedTime or datetime(*zi.date_time)))
+
+      exportFiles = ((realPath, relPath) for realPath, relPath in _walkExport(tmpDir) \
+        if shardKeys is None or _shardKey(relPath) in shardKeys) # Skip other shard's
+      try:
+        if jobs > 1:
+          _runPipeline(renamer, exportFiles, rewriteFile, writeFile)
+        else:
+          for realPath, relPath in exportFiles:
+            toWrite = rewriteFile(realPath, relPath)
+            if toWrite:
+              writeFile(toWrite)
+      finally:
+        renamer.close()
+      if manifest:
+        print(f"Writing manifest as '{manifestEntryName}'")
+        writeManifest(zf, sorted(manifestLines, key=_manifestLineSortKey))
   return newZipPath
 
 
@@ -292,8 +1220,8 @@ def cli(argv):
   CLI entrypoint, takes CLI arguments array
   """
   parser = argparse.ArgumentParser(description='Prettifies Notion .zip exports')
-  parser.add_argument('token_v2', type=str,
-                      help='the token for your Notion.so session')
+  parser.add_argument('token_v2', type=str, nargs='?',
+                      help='the token for your Notion.so session, optional with --no-api')
   parser.add_argument('zip_path', type=str,
                       help='the path to the Notion exported .zip file')
   parser.add_argument('--output-path', action='store', type=str, default=".",
@@ -302,17 +1230,55 @@ def cli(argv):
                       help='Removes the title that Notion adds. H1s at the top of every file')
   parser.add_argument('--rewrite-paths', action='store_false', default=True,
                       help='Rewrite the paths in the Markdown files themselves to match file renaming')
+  parser.add_argument('--no-api', action='store_true',
+                      help='Get names and times from the export itself, only querying Notion (if a token is given) for the ones that can\'t be. Doesn\'t add icons')
+  parser.add_argument('--dedupe-attachments', action='store', choices=['report', 'collapse'], default=None,
+                      help='Find attachments with the same content. "report" lists them and only compresses them once, "collapse" only keeps the first one and points links at it')
+  parser.add_argument('--jobs', action='store', type=int, default=1,
+                      help='How many names to look up at the same time. Above 1, looking up names, rewriting files and writing the zip overlap, with the same output')
+  parser.add_argument('--manifest', action='store_true',
+                      help=f'Add a manifest of the Notion ID, original path, new path, content hash and times of every file to the output, as \'{manifestEntryName}\'')
+  parser.add_argument('--shard', action='store', type=str, default=None,
+                      help='Only process one shard of the export, like "0/4" for the first of 4. Shards can be processed in separate processes or on separate machines, then combined with --merge-shards')
+  parser.add_argument('--merge-shards', action='store', type=int, default=None,
+                      help='Combine this many shard outputs in the output path into a single output instead of processing the export')
   args = parser.parse_args(argv)
+  if not args.token_v2 and not args.no_api and args.merge_shards is None:
+    parser.error('token_v2 is required unless using --no-api or --merge-shards')
+  if args.shard and args.merge_shards is not None:
+    parser.error('--shard and --merge-shards can\'t be used together')
+  shard = None
+  if args.shard:
+    match = re.fullmatch(r"(\d+)/(\d+)", args.shard)
+    if not match or int(match[1]) >= int(match[2]):
+      parser.error('--shard must be like "0/4", with the index less than the count')
+    shard = (int(match[1]), int(match[2]))
 
   startTime = time.time()
-  nCl = NotionClient(token_v2=args.token_v2)
-  nCl.get_block = backoff.on_exception(backoff.expo,
-                      requests.exceptions.HTTPError,
-                      max_tries=5,
-                      )(nCl.get_block)
+  if args.merge_shards is not None:
+    if args.merge_shards < 1:
+      parser.error('--merge-shards must be at least 1')
+    newZipPath = os.path.join(args.output_path, f"{os.path.basename(args.zip_path)}.formatted")
+    shardPaths = [shardZipPath(newZipPath, i, args.merge_shards) for i in range(args.merge_shards)]
+    missingPaths = [p for p in shardPaths if not os.path.isfile(p)]
+    if missingPaths:
+      parser.error(f"--merge-shards {args.merge_shards} is missing shard outputs: {', '.join(missingPaths)}")
+    outFileName = mergeNotionZipShards(shardPaths, newZipPath)
+    print("--- Finished in %s seconds ---" % (time.time() - startTime))
+    print(f"Output file written as '{outFileName}'")
+    return
+
+  nCl = None
+  if args.token_v2:
+    nCl = NotionClient(token_v2=args.token_v2)
+    nCl.get_block = backoff.on_exception(backoff.expo,
+                        requests.exceptions.HTTPError,
+                        max_tries=5,
+                        )(nCl.get_block)
 
   outFileName = rewriteNotionZip(nCl, args.zip_path, outputPath=args.output_path,
-    removeTopH1=args.remove_title, rewritePaths=args.rewrite_paths)
+    removeTopH1=args.remove_title, rewritePaths=args.rewrite_paths, noApi=args.no_api, shard=shard,
+    dedupeAttachments=args.dedupe_attachments, jobs=args.jobs, manifest=args.manifest)
   print("--- Finished in %s seconds ---" % (time.time() - startTime))
   print(f"Output file written as '{outFileName}'")
 
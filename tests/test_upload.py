@@ -4,13 +4,19 @@ Tests NotionPyRenderer parsing
 import pytest
 from datetime import datetime
 import io
+import random
+import time
+import threading
+import hashlib
 import sys
 import os
 import re
 import zipfile
 import requests
-from notion_export_enhancer.enhancer import noteNameRewrite, NotionExportRenamer, \
-    mdFileRewrite, rewriteNotionZip
+from notion_export_enhancer.enhancer import noteNameRewrite, noteNameRewriteFromExport, \
+    NotionExportRenamer, mdLinkTargetSpans, mdFileRewrite, rewriteNotionZip, planNotionZipShards, \
+    mergeNotionZipShards, manifestEntryName, manifestLine, writeManifest, lookupManifest, shardZipPath, cli, \
+    _manifestLineSortKey
 from notion.block import PageBlock, ImageBlock
 from unittest.mock import Mock, patch
 
@@ -198,6 +204,60 @@ def test_noteNameRewrite_times():
     assert ret == ('owo', datetime.fromtimestamp(1555555555), datetime.fromtimestamp(16666666666.777))
 
 
+def test_noteNameRewriteFromExport_non_matching_names():
+    '''it will return None tuple when not matching pattern'''
+    #act/assert
+    assert noteNameRewriteFromExport('', 'asdf') == (None, None, None)
+    assert noteNameRewriteFromExport('', os.path.join('a', 'asdf 4fe9r0ogij')) == (None, None, None)
+
+def test_noteNameRewriteFromExport_title_and_properties():
+    '''it will retruncate names from the H1 and get times from the properties'''
+    #arrange
+    rootPath = os.path.join(testsRoot, 'test_files', 'no_api')
+
+    #act
+    ret = noteNameRewriteFromExport(rootPath, 'abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwx 0123456789abcdef0123456789abcdef')
+
+    #assert
+    assert ret == ('abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwxyz', datetime(2021, 1, 2, 4, 5), datetime(2021, 2, 3, 17, 6))
+
+def test_noteNameRewriteFromExport_times_from_file():
+    '''it will use the time of the md file when there are no time properties'''
+    #arrange
+    rootPath = os.path.join(testsRoot, 'test_files', 'no_api')
+    mdTime = datetime.fromtimestamp(os.path.getmtime(os.path.join(rootPath, 'short 00000000000000000000000000000000.md')))
+
+    #act
+    ret = noteNameRewriteFromExport(rootPath, 'short 00000000000000000000000000000000')
+
+    #assert
+    assert ret == ('short', mdTime, mdTime)
+
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_noteNameRewriteFromExport_truncated_without_title(mockStdout):
+    '''it will return None tuple when a truncated name has no md file to get the title from'''
+    #act
+    ret = noteNameRewriteFromExport('', 'abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwx 0123456789abcdef0123456789abcdef')
+
+    #assert
+    assert ret == (None, None, None)
+    assert re.search(r"No title", mockStdout.getvalue(), flags=re.IGNORECASE)
+
+def test_NotionExportRewriter_renameAndTimesWithNotion_no_api():
+    '''it will only query Notion for names it can't resolve from the export'''
+    #arrange
+    nCl = MockClient({
+        '11111111111111111111111111111111': MockBlock(title="abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwxyz!"),
+    })
+    rn = NotionExportRenamer(nCl, os.path.join(testsRoot, 'test_files', 'no_api'), noApi=True)
+
+    #act
+    ret = rn.renameAndTimesWithNotion('abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwx 0123456789abcdef0123456789abcdef.md')
+    ret2 = rn.renameAndTimesWithNotion('abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwx 11111111111111111111111111111111.md')
+
+    #assert
+    assert ret == ('abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwxyz.md', datetime(2021, 1, 2, 4, 5), datetime(2021, 2, 3, 17, 6))
+    assert ret2 == ('abcdefghijklmnopqrstuvwxyzabcdefghijklmnopqrstuvwxyz!.md', defaultBlockTime, defaultBlockTime)
 
 def test_NotionExportRewriter_renameAndTimesWithNotion_no_rename():
     '''it will not rename paths that dont match'''
@@ -259,6 +319,25 @@ def test_NotionExportRewriter_renameAndTimesWithNotion_rename_collision_handle()
     assert ret2 == ('c (1).md', defaultBlockTime, defaultBlockTime)
     assert ret3 == ('c (2).md', defaultBlockTime, defaultBlockTime)
 
+def test_NotionExportRewriter_renameAndTimesWithNotion_collision_order(tmp_path):
+    '''it will handle collisions the same no matter what order paths are renamed in, if they're on disk'''
+    #arrange
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(),
+        '00000000000000000000000000000000': MockBlock(),
+    })
+    (tmp_path / 'c 0123456789abcdef0123456789abcdef.md').write_text('')
+    (tmp_path / 'c 00000000000000000000000000000000.md').write_text('')
+    rn = NotionExportRenamer(nCl, str(tmp_path))
+
+    #act
+    ret = rn.renameAndTimesWithNotion('c 0123456789abcdef0123456789abcdef.md')
+    ret2 = rn.renameAndTimesWithNotion('c 00000000000000000000000000000000.md')
+
+    #assert
+    assert ret == ('c (1).md', defaultBlockTime, defaultBlockTime)
+    assert ret2 == ('c.md', defaultBlockTime, defaultBlockTime)
+
 def test_NotionExportRewriter_renameWithNotion_simple_rename():
     '''it will rename if path matches and only return name'''
     #arrange
@@ -307,6 +386,153 @@ def test_NotionExportRewriter_renamePathAndTimesWithNotion_simple_rename():
     #assert
     assert ret == (os.path.join('a', 'b', 'c.md'), datetime.fromtimestamp(1000000000), datetime.fromtimestamp(1111111111))
 
+def test_mdLinkTargetSpans():
+    '''it will find the targets of all kinds of links and images'''
+    #arrange
+    md = """[a](b(c)d) ![i](<x y.png>) \\[not](a%20link) [e](f "title") [x][REF] [ref  2]
+[ref]: some%20path.md
+   [ref2 ]: <other path.md>
+[ref 2]: used%20path.md
+[^1]: footnote
+[Unused]: not%20a%20link
+<img alt="x" src="pic.png"> <IMG SRC='pic2.png'/>
+[a](b[c](d)) [f](g\\)h.md)"""
+
+    #act
+    ret = mdLinkTargetSpans(md)
+
+    #assert
+    assert [md[start:end] for start, end in ret] == ['b(c)d', 'x y.png', 'some%20path.md', 'used%20path.md', 'pic.png', 'pic2.png', 'b[c](d)', 'g\\)h.md']
+    assert [md[start:end] for start, end in mdLinkTargetSpans(md, isUnusedDefinitionTarget=lambda t: t != 'not%20a%20link')] == \
+        ['b(c)d', 'x y.png', 'some%20path.md', 'other path.md', 'used%20path.md', 'pic.png', 'pic2.png', 'b[c](d)', 'g\\)h.md']
+
+def test_mdFileRewrite_rewrite_paths_definition_lookalikes(tmp_path):
+    '''it will leave lines that only look like reference definitions alone, unless they point at a file in the export'''
+    #arrange
+    md = """[Warning]: don't run this on prod
+[1]: café menu
+[Page]: Page%200123456789abcdef0123456789abcdef.md"""
+    (tmp_path / 'Page 0123456789abcdef0123456789abcdef.md').write_text('# Page')
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(),
+    })
+    rn = NotionExportRenamer(nCl, str(tmp_path))
+
+    #act
+    ret = mdFileRewrite(rn, 'c.md', mdFileContents=md, rewritePaths=True)
+
+    #assert
+    assert ret == """[Warning]: don't run this on prod
+[1]: café menu
+[Page]: Page.md"""
+
+def test_mdFileRewrite_rewrite_paths_outside_export(tmp_path):
+    '''it will leave links to outside of the export alone without listing or looking up anything there'''
+    #arrange
+    md = """[out](../outside/y%2011111111111111111111111111111111.md) [abs](/outside/y.md)"""
+    (tmp_path / 'export').mkdir()
+    (tmp_path / 'export' / 'c 0123456789abcdef0123456789abcdef.md').write_text(md)
+    (tmp_path / 'outside').mkdir()
+    (tmp_path / 'outside' / 'y 11111111111111111111111111111111.md').write_text('# Y')
+    (tmp_path / 'z 22222222222222222222222222222222.md').write_text('# Z')
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(), # Any other lookup raises a KeyError
+    })
+    rn = NotionExportRenamer(nCl, str(tmp_path / 'export'))
+
+    #act
+    ret = mdFileRewrite(rn, 'c 0123456789abcdef0123456789abcdef.md', mdFileContents=md, rewritePaths=True)
+
+    #assert
+    assert ret == md
+
+def test_mdFileRewrite_rewrite_paths_escapes_and_schemes():
+    '''it will unescape targets before renaming them and leave any target with a URI scheme alone'''
+    md = """[esc](d\\)%200123456789abcdef0123456789abcdef.md)
+
+<img src="data:image/png;base64,iVBOR/AAA="> [mail](mailto:a@example.com) [web](https://example.com/a%20b)"""
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(),
+    })
+    rn = NotionExportRenamer(nCl, '')
+
+    #act
+    ret = mdFileRewrite(rn, os.path.join('a', 'b', 'c.md'), mdFileContents=md, rewritePaths=True)
+
+    #assert
+    assert ret == """[esc](d%29.md)
+
+<img src="data:image/png;base64,iVBOR/AAA="> [mail](mailto:a@example.com) [web](https://example.com/a%20b)"""
+
+def test_mdLinkTargetSpans_fuzz_links():
+    '''it will find exactly the targets of randomly generated links among random text'''
+    rng = random.Random(1234)
+    for _ in range(500):
+        #arrange
+        parts = []
+        expected = []
+        length = 0
+        for _ in range(rng.randint(0, 20)):
+            if rng.random() < 0.5:
+                part = "".join(rng.choice("ab !:#\n") for _ in range(rng.randint(0, 10)))
+            else:
+                text = "".join(rng.choice("ab ()!") for _ in range(rng.randint(0, 5)))
+                target = "".join(rng.choice("ab%._/") for _ in range(rng.randint(1, 8)))
+                if rng.random() < 0.3:
+                    target = f"{target}({target})"
+                prefix = f"{rng.choice(['', '!'])}[{text}]("
+                part = f"{prefix}{target}) "
+                expected.append((length + len(prefix), length + len(prefix) + len(target)))
+            parts.append(part)
+            length += len(part)
+
+        #act
+        ret = mdLinkTargetSpans("".join(parts))
+
+        #assert
+        assert ret == expected
+
+def test_mdLinkTargetSpans_fuzz_garbage():
+    '''it will always return sorted, non-overlapping, in bounds spans for random text'''
+    rng = random.Random(4321)
+    for _ in range(2000):
+        #arrange
+        md = "".join(rng.choice("[]()<>!:\\ \n\"'=ab") + rng.choice(["", "", "", "img ", "src="]) for _ in range(rng.randint(0, 60)))
+
+        #act
+        ret = mdLinkTargetSpans(md)
+
+        #assert
+        lastEnd = 0
+        for start, end in ret:
+            assert lastEnd <= start < end <= len(md)
+            lastEnd = end
+
+@pytest.mark.parametrize("md", [
+    "[" * 200000,
+    "[a](" * 50000,
+    "](" * 100000,
+    "\\[" * 100000,
+    "(" * 200000,
+    "[" + "(" * 200000 + "]",
+    "[a](<" * 40000,
+    "[a]:" * 50000,
+    "\n[a]: " * 30000,
+    "<img " * 40000,
+    "<img src=\"" * 20000 + ">",
+    "[a](b)" * 30000,
+    "[" * 100000 + "]" * 100000,
+    "[" + "a" * 200000 + "]\n[" + "a" * 200000 + "]: b",
+])
+def test_mdLinkTargetSpans_worst_case_time(md):
+    '''it will take linear time on pathological input (quadratic would take minutes here)'''
+    #act
+    startTime = time.time()
+    mdLinkTargetSpans(md)
+
+    #assert
+    assert time.time() - startTime < 5
+
 def test_mdFileRewrite_no_op():
     '''it will do nothing to md files by default'''
     md = """# I'm really good at taking copypastas from reddit and putting them in 
@@ -459,4 +685,355 @@ Until it gives and it lets out a soft
 * Soft
 * Agile
 
-[beep](../device.md)"""
\ No newline at end of file
+[beep](../device.md)"""
+
+def test_rewriteNotionZip_no_api(tmp_path):
+    '''it will rewrite an entire zip file without a NotionClient, using times from the export'''
+    #arrange
+    zipPath = os.path.join(testsRoot, 'test_files', 'zip_complex.zip')
+    with zipfile.ZipFile(zipPath) as zf:
+        deviceTime = zf.getinfo('device 00000000000000000000000000000000.md').date_time
+        csvTime = zf.getinfo('something_else.csv').date_time
+
+    #act
+    outputFilePath = rewriteNotionZip(None, zipPath, outputPath=str(tmp_path), noApi=True)
+
+    #assert
+    with zipfile.ZipFile(outputFilePath) as zf:
+        assert zf.testzip() == None
+        assert set(zf.namelist()) == set(['beep/!index.md', 'beep/types.md', 'device.md', 'something_else.csv'])
+        assert zf.getinfo('device.md').date_time == deviceTime
+        assert zf.getinfo('something_else.csv').date_time == csvTime
+        assert zf.open('beep/!index.md').read().decode('utf-8').endswith("[Types](types.md)")
+
+def test_planNotionZipShards():
+    '''it will split top-level subtrees into shards, keeping md files with their folders'''
+    #act
+    shards = planNotionZipShards(os.path.join(testsRoot, 'test_files', 'zip_complex.zip'), 2)
+
+    #assert
+    assert len(shards) == 2
+    assert shards[0] | shards[1] == set(['beep 0123456789abcdef0123456789abcdef', 'device 00000000000000000000000000000000', 'something_else.csv'])
+    assert not shards[0] & shards[1]
+
+def test_rewriteNotionZip_shards(tmp_path):
+    '''it will give the same output for merged shards as for a single run'''
+    #arrange
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '00000000000000000000000000000000': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '11111111111111111111111111111111': MockBlock(icon="📟", lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+    })
+    zipPath = os.path.join(testsRoot, 'test_files', 'zip_complex.zip')
+    (tmp_path / 'single').mkdir()
+    (tmp_path / 'shards').mkdir()
+
+    #act
+    singlePath = rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path / 'single'), manifest=True)
+    shardPaths = [rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path / 'shards'), shard=(i, 2), manifest=True) for i in range(2)]
+    mergedPath = mergeNotionZipShards(shardPaths, str(tmp_path / 'merged.zip'))
+
+    #assert
+    with zipfile.ZipFile(singlePath) as singleZf, zipfile.ZipFile(mergedPath) as mergedZf:
+        assert mergedZf.testzip() == None
+        assert set(mergedZf.namelist()) == set(singleZf.namelist())
+        for name in singleZf.namelist():
+            assert mergedZf.read(name) == singleZf.read(name)
+            assert mergedZf.getinfo(name).date_time == singleZf.getinfo(name).date_time
+            assert mergedZf.getinfo(name).compress_size == singleZf.getinfo(name).compress_size
+
+@patch('sys.stderr', new_callable=io.StringIO)
+def test_cli_merge_shards_errors(mockStderr, tmp_path):
+    '''it will exit with a usage error for missing shard outputs or --shard with --merge-shards'''
+    #arrange
+    newZipPath = str(tmp_path / 'export.zip.formatted')
+    with zipfile.ZipFile(shardZipPath(newZipPath, 0, 2), 'w'):
+        pass
+
+    #act
+    with pytest.raises(SystemExit):
+        cli(['export.zip', '--output-path', str(tmp_path), '--merge-shards', '2'])
+    with pytest.raises(SystemExit):
+        cli(['export.zip', '--output-path', str(tmp_path), '--merge-shards', '2', '--shard', '0/2'])
+
+    #assert
+    assert 'missing shard outputs: ' + shardZipPath(newZipPath, 1, 2) in mockStderr.getvalue()
+    assert "--shard and --merge-shards can't be used together" in mockStderr.getvalue()
+    assert not os.path.exists(newZipPath)
+
+def MockDuplicatesClient():
+    return MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '00000000000000000000000000000000': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+    })
+
+@patch('sys.stdout', new_callable=io.StringIO)
+def test_rewriteNotionZip_dedupe_attachments_report(mockStdout, tmp_path):
+    '''it will report duplicate attachments and only compress them once'''
+    #act
+    outputFilePath = rewriteNotionZip(MockDuplicatesClient(), os.path.join(testsRoot, 'test_files', 'zip_duplicates.zip'),
+        outputPath=str(tmp_path), dedupeAttachments="report")
+
+    #assert
+    assert re.search(r"page 0123456789abcdef0123456789abcdef.image\.png' is a duplicate of 'other 00000000000000000000000000000000.copy\.png'", mockStdout.getvalue())
+    with zipfile.ZipFile(outputFilePath) as zf:
+        assert zf.testzip() == None
+        assert set(zf.namelist()) == set(['other/!index.md', 'other/copy.png', 'other/different.png', 'page/!index.md', 'page/image.png'])
+        assert zf.read('page/image.png') == zf.read('other/copy.png')
+        assert zf.read('page/!index.md').decode('utf-8') == """# Page
+
+![](image.png)
+
+[Other](../other/%21index.md)"""
+
+def test_rewriteNotionZip_dedupe_attachments_collapse(tmp_path):
+    '''it will only write the first of duplicate attachments and point links at it'''
+    #act
+    outputFilePath = rewriteNotionZip(MockDuplicatesClient(), os.path.join(testsRoot, 'test_files', 'zip_duplicates.zip'),
+        outputPath=str(tmp_path), dedupeAttachments="collapse")
+
+    #assert
+    with zipfile.ZipFile(outputFilePath) as zf:
+        assert zf.testzip() == None
+        assert set(zf.namelist()) == set(['other/!index.md', 'other/copy.png', 'other/different.png', 'page/!index.md'])
+        assert zf.read('page/!index.md').decode('utf-8') == """# Page
+
+![](../other/copy.png)
+
+[Other](../other/%21index.md)"""
+        assert zf.read('other/!index.md').decode('utf-8') == """# Other
+
+![](copy.png)
+
+![](different.png)"""
+
+def test_rewriteNotionZip_dedupe_attachments_skips_databases(tmp_path):
+    '''it will never collapse databases or pages, even when they have the same content'''
+    #arrange
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(title='Page', lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '11111111111111111111111111111111': MockBlock(title='Tasks', lastEditedTime="1609459200000"),
+        '22222222222222222222222222222222': MockBlock(title='Bugs', lastEditedTime="1609459200000"),
+    })
+    zipPath = str(tmp_path / 'export.zip')
+    with zipfile.ZipFile(zipPath, 'w') as zf:
+        zf.writestr('Page 0123456789abcdef0123456789abcdef.md', """# Page
+
+[Tasks](Tasks%2011111111111111111111111111111111.csv) [Bugs](Bugs%2022222222222222222222222222222222.csv)
+[Old](Page%200123456789abcdef0123456789abcdef/old.csv) [New](Page%200123456789abcdef0123456789abcdef/new.csv)""")
+        zf.writestr('Tasks 11111111111111111111111111111111.csv', 'Name,Tags\n')
+        zf.writestr('Bugs 22222222222222222222222222222222.csv', 'Name,Tags\n')
+        zf.writestr('Page 0123456789abcdef0123456789abcdef/old.csv', 'Name,Tags\n')
+        zf.writestr('Page 0123456789abcdef0123456789abcdef/new.csv', 'Name,Tags\n')
+
+    #act
+    outputFilePath = rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path), dedupeAttachments="collapse")
+
+    #assert
+    with zipfile.ZipFile(outputFilePath) as zf:
+        assert set(zf.namelist()) == set(['Page/!index.md', 'Page/old.csv', 'Page/new.csv', 'Tasks.csv', 'Bugs.csv'])
+        assert zf.read('Tasks.csv') == b'Name,Tags\n'
+        assert zf.read('Page/!index.md').decode('utf-8') == """# Page
+
+[Tasks](../Tasks.csv) [Bugs](../Bugs.csv)
+[Old](old.csv) [New](new.csv)"""
+
+@pytest.mark.parametrize("zipName,dedupeAttachments", [
+    ('zip_complex.zip', None),
+    ('zip_duplicates.zip', "report"),
+    ('zip_duplicates.zip', "collapse"),
+])
+def test_rewriteNotionZip_jobs(tmp_path, zipName, dedupeAttachments):
+    '''it will write the exact same bytes when running as a pipeline with multiple jobs'''
+    #arrange
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '00000000000000000000000000000000': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '11111111111111111111111111111111': MockBlock(icon="📟", lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+    })
+    zipPath = os.path.join(testsRoot, 'test_files', zipName)
+    (tmp_path / 'serial').mkdir()
+    (tmp_path / 'pipeline').mkdir()
+
+    #act
+    serialPath = rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path / 'serial'), dedupeAttachments=dedupeAttachments, manifest=True)
+    pipelinePath = rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path / 'pipeline'), dedupeAttachments=dedupeAttachments, jobs=4, manifest=True)
+
+    #assert
+    with open(serialPath, 'rb') as serialF, open(pipelinePath, 'rb') as pipelineF:
+        assert serialF.read() == pipelineF.read()
+
+def test_rewriteNotionZip_jobs_error(tmp_path):
+    '''it will raise errors from any stage of the pipeline'''
+    #arrange
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(),
+    })
+
+    #act/assert
+    with pytest.raises(KeyError):
+        rewriteNotionZip(nCl, os.path.join(testsRoot, 'test_files', 'zip_complex.zip'), outputPath=str(tmp_path), jobs=4)
+
+def test_rewriteNotionZip_jobs_overlap(tmp_path):
+    '''it will look names up on other threads at the same time, including folders that links point into'''
+    #arrange
+    pageCount = 12
+    lookupTime = 0.05
+    blockMap = {}
+    zipPath = str(tmp_path / 'export.zip')
+    with zipfile.ZipFile(zipPath, 'w') as zf:
+        for i in range(pageCount):
+            pageId = f"{i:032x}"
+            childId = f"{i + pageCount:032x}"
+            blockMap[pageId] = MockBlock(title=f"Page {i}", createdTime="1609459200000")
+            blockMap[childId] = MockBlock(title=f"Child {i}", createdTime="1609459200000")
+            # Link into the folder of the next page, which rewriting hasn't gotten to yet
+            n = (i + 1) % pageCount
+            zf.writestr(f"Page {i} {pageId}.md", f"# Page {i}\n\n[Next](Page%20{n}%20{n:032x}/Child%20{n}%20{n + pageCount:032x}.md)")
+            zf.writestr(f"Page {i} {pageId}/Child {i} {childId}.md", f"# Child {i}")
+    lookupThreads = []
+    lookupCounts = { 'running': 0, 'maxRunning': 0 }
+    lookupLock = threading.Lock()
+    def sleepyGetBlock(bId):
+        with lookupLock:
+            lookupThreads.append(threading.current_thread())
+            lookupCounts['running'] += 1
+            lookupCounts['maxRunning'] = max(lookupCounts['maxRunning'], lookupCounts['running'])
+        time.sleep(lookupTime)
+        with lookupLock:
+            lookupCounts['running'] -= 1
+        return blockMap[bId]
+    nCl = Mock()
+    nCl.get_block = sleepyGetBlock
+    seal(nCl)
+    (tmp_path / 'serial').mkdir()
+    (tmp_path / 'pipeline').mkdir()
+
+    #act
+    serialPath = rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path / 'serial'), jobs=1)
+    assert lookupCounts['maxRunning'] == 1
+    del lookupThreads[:]
+    pipelinePath = rewriteNotionZip(nCl, zipPath, outputPath=str(tmp_path / 'pipeline'), jobs=8)
+
+    #assert
+    assert len(lookupThreads) == pageCount * 3 # Page folders and .md files are looked up separately
+    assert all([t.name.startswith("NotionLookup") for t in lookupThreads]) # Never waited on inline
+    assert lookupCounts['maxRunning'] > 1
+    with open(serialPath, 'rb') as serialF, open(pipelinePath, 'rb') as pipelineF:
+        assert serialF.read() == pipelineF.read()
+    with zipfile.ZipFile(pipelinePath) as zf:
+        assert zf.read('Page 0/!index.md').decode('utf-8') == "# Page 0\n\n[Next](../Page%201/Child%201.md)"
+
+def test_NotionExportRenamer_prefetch_bounded(tmp_path):
+    '''it will block prefetching once maxPrefetches lookups haven't finished'''
+    #arrange
+    ids = [f"{i:032x}" for i in range(10)]
+    for bId in ids:
+        (tmp_path / f"p {bId}.md").write_text("# P")
+    lookupsBlocked = threading.Event()
+    def blockedGetBlock(bId):
+        lookupsBlocked.wait()
+        return MockBlock(lastEditedTime="1609459200000")
+    nCl = Mock()
+    nCl.get_block = blockedGetBlock
+    seal(nCl)
+    rn = NotionExportRenamer(nCl, str(tmp_path), jobs=2, maxPrefetches=3)
+    prefetched = []
+    def prefetchAll():
+        for bId in ids:
+            rn.prefetchWithNotion(f"p {bId}.md")
+            prefetched.append(bId)
+    prefetchThread = threading.Thread(target=prefetchAll, daemon=True)
+
+    #act
+    prefetchThread.start()
+    prefetchThread.join(0.5)
+    prefetchedWhileBlocked = len(prefetched)
+    lookupsBlocked.set()
+    prefetchThread.join(5)
+    names = [rn.renameWithNotion(f"p {bId}.md") for bId in ids]
+    rn.close()
+
+    #assert
+    assert prefetchedWhileBlocked == 3
+    assert len(prefetched) == 10
+    assert names == ["p.md"] + [f"p ({i}).md" for i in range(1, 10)]
+
+def test_rewriteNotionZip_manifest(tmp_path):
+    '''it will add a manifest of every file that can be looked up without reading the zip'''
+    #arrange
+    nCl = MockClient({
+        '0123456789abcdef0123456789abcdef': MockBlock(createdTime="1000000000000", lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '00000000000000000000000000000000': MockBlock(lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+        '11111111111111111111111111111111': MockBlock(icon="📟", lastEditedTime="1609459200000"), #1/1/2021 12:00:00 AM
+    })
+
+    #act
+    outputFilePath = rewriteNotionZip(nCl, os.path.join(testsRoot, 'test_files', 'zip_complex.zip'), outputPath=str(tmp_path), manifest=True)
+
+    #assert
+    with zipfile.ZipFile(outputFilePath) as zf:
+        assert zf.testzip() == None
+        assert zf.infolist()[-1].filename == manifestEntryName
+        assert zf.infolist()[-1].compress_type == zipfile.ZIP_STORED
+        indexHash = hashlib.sha256(zf.read('beep/!index.md')).hexdigest()
+    assert lookupManifest(outputFilePath, '0123456789abcdef0123456789abcdef') == [{
+        'key': '0123456789abcdef0123456789abcdef',
+        'originalPath': 'beep 0123456789abcdef0123456789abcdef.md',
+        'newPath': 'beep/!index.md',
+        'sha256': indexHash,
+        'createdTime': datetime.fromtimestamp(1000000000),
+        'lastEditedTime': datetime.fromtimestamp(1609459200),
+    }]
+    assert lookupManifest(outputFilePath, 'something_else.csv')[0]['newPath'] == 'something_else.csv'
+    assert lookupManifest(outputFilePath, '22222222222222222222222222222222') == []
+
+def test_lookupManifest_unusual_paths(tmp_path):
+    '''it will find entries whose keys have control characters or other line breaks, through a merge too'''
+    #arrange
+    paths = ["a", "a\x01", "b\u2028c.png", "d\re\x85.png", "f\\g\th\ni.png"]
+    lines = [manifestLine(p, p + ".new", "", None, None) for p in paths]
+    shardPath = str(tmp_path / 'shard.zip')
+    with zipfile.ZipFile(shardPath, 'w') as zf:
+        writeManifest(zf, sorted(lines, key=_manifestLineSortKey))
+
+    #act
+    mergedPath = mergeNotionZipShards([shardPath], str(tmp_path / 'merged.zip'))
+
+    #assert
+    for zipPath in [shardPath, mergedPath]:
+        for p in paths:
+            assert [r['newPath'] for r in lookupManifest(zipPath, p)] == [p + ".new"]
+
+def test_lookupManifest_compressed(tmp_path):
+    '''it will still find entries when something else recompressed the manifest'''
+    #arrange
+    key = "0123456789abcdef0123456789abcdef"
+    zipPath = str(tmp_path / 'manifest.zip')
+    with zipfile.ZipFile(zipPath, 'w') as zf:
+        zf.writestr(zipfile.ZipInfo(manifestEntryName), "\t".join(["key", "originalPath", "newPath", "sha256", "createdTime", "lastEditedTime"]) + "\n" + \
+            manifestLine(f"a {key}.md", "a.md", "", None, None) * 50, compress_type=zipfile.ZIP_DEFLATED)
+
+    #act
+    ret = lookupManifest(zipPath, key)
+
+    #assert
+    assert [r['newPath'] for r in ret] == ["a.md"] * 50
+
+def test_lookupManifest_many(tmp_path):
+    '''it will find every entry of a big manifest, including ones sharing a key'''
+    #arrange
+    rng = random.Random(5678)
+    keys = sorted(set(f"{rng.getrandbits(128):032x}" for _ in range(2000)))
+    lines = [manifestLine(f"n\t{k} {k}.md", f"n\t{k}.md", "", None, None) for k in keys]
+    lines += [manifestLine(f"n {keys[0]}.csv", "n.csv", "", None, None)] # Shares a key with an .md
+    zipPath = str(tmp_path / 'manifest.zip')
+    with zipfile.ZipFile(zipPath, 'w') as zf:
+        writeManifest(zf, sorted(lines, key=_manifestLineSortKey))
+
+    #act/assert
+    for k in keys[1:]:
+        assert [r['newPath'] for r in lookupManifest(zipPath, k)] == [f"n\t{k}.md"]
+    assert len(lookupManifest(zipPath, keys[0])) == 2
+    assert lookupManifest(zipPath, "0" * 31) == []
+    assert lookupManifest(zipPath, "g" * 32) == []